@@ -1,5 +1,18 @@
+import asyncio
+import concurrent.futures
+import functools
+import glob
+import hashlib
 import os
-import pandas as pd
+import sys
+import time
+import unicodedata
+from collections import OrderedDict
+import openpyxl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyroaring import BitMap
+from rapidfuzz import fuzz, process
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
@@ -15,6 +28,62 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Reply templates for cipher search
+RESPONSE_PREFIX_FMT = "Найденные программы для шифра '{q}':\n\n```\nВы можете поступить в наш университет по данным ГОП:\n"
+RESPONSE_DOCS_BLOCK = (
+    "\n\nСписок необходимых документов:\n"
+    "1. Диплом с приложением (оригинал + копия)\n"
+    "2. Сертификат ЕНТ при сдаче.\n"
+    "3. Копия удостоверения личности.\n"
+    "4. Медицинская справка формы 075-у со снимком флюрографии.\n"
+    "5. Медицинская справка формы 063 (паспорт здоровья).\n"
+    "6. Фотография 3х4 в электронном формате.\n"
+    "\n"
+    "Для дополнительной информации: https://www.ektu.kz/admissiondetails.aspx?ttab=1```"
+)
+RESPONSE_COUNT_FMT = "\n\nВсего найдено: {count} программ(ы)"
+NOT_FOUND_FMT = (
+    "❌ Не найдено программ для шифра '{q}'\n\n"
+    "Проверьте правильность написания шифра.\n\n Если данная ошибка повторяется, то у нас нет ГОП по данному шифру"
+)
+DID_YOU_MEAN_FMT = (
+    "❓ Не найдено программ для шифра '{q}'\n\n"
+    "Возможно, вы имели в виду шифр '{cipher}'? Отправьте его, чтобы увидеть подходящие образовательные программы.\n\n"
+    " Если шифр написан правильно, то у нас нет ГОП по данному шифру"
+)
+SAME_RESPONSE_TEXT = "См. предыдущий ответ ↑"
+
+# Version of the processed records stored in the Parquet cache,
+# bump whenever read_excel changes what it produces
+CACHE_VERSION = 1
+
+# Minimum fuzz.ratio score for the closest cipher code to count as a match
+FUZZY_SCORE_CUTOFF = 85
+
+def cell_to_str(value):
+    """Convert an Excel cell value to stripped text, writing whole numbers without a decimal part"""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+def dictionary_column_to_list(column):
+    """Convert a dictionary-encoded Arrow column to a list, decoding each unique string once"""
+    values = []
+    for chunk in column.chunks:
+        dictionary = chunk.dictionary.to_pylist()
+        values.extend(dictionary[index] for index in chunk.indices.to_pylist())
+    return values
+
+def is_digit_substitution(first, second):
+    """Check if two codes of the same length differ only in digits, which makes them different codes rather than a typo"""
+    return len(first) == len(second) and all(
+        a == b or (a.isdigit() and b.isdigit()) for a, b in zip(first, second)
+    )
+
+def normalize_cipher(text):
+    """Normalize a cipher code for lookups: NFKC form, no surrounding whitespace, case folded"""
+    return unicodedata.normalize('NFKC', text).strip().casefold()
+
 class EducationalProgramBot:
     def __init__(self, excel_file_path):
         """
@@ -27,73 +96,213 @@ class EducationalProgramBot:
         Column D: Name of cipher
         """
         self.excel_file_path = excel_file_path
-        self.data = None
+        self.reset_data()
+        # Cache results for repeated queries, cleared whenever data is reloaded
+        self.search_cache = functools.lru_cache(maxsize=2048)(self.find_programs)
+        # Fully formatted replies per query, evicted in least recently used order
+        self.response_cache = OrderedDict()
+        self.response_cache_size = 2048
+        # Searches run in this pool so the event loop keeps serving other updates
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='search')
+        # Searches currently running in the executor, keyed by query
+        self.inflight = {}
+        # Last search reply per chat as (message id, reply hash, send time),
+        # evicted in least recently used order
+        self.last_responses = OrderedDict()
+        self.last_responses_size = 2048
+        # Seconds during which a repeated reply points back to the previous message
+        self.same_response_window = 300
         self.load_data()
 
     def load_data(self):
-        """Load data from Excel file"""
+        """Load data from Excel file, using the Parquet cache when it is up to date"""
+        self.search_cache.cache_clear()
+        self.response_cache.clear()
         try:
-            # Read Excel file
-            self.data = pd.read_excel(self.excel_file_path, header=None)
+            cache_path = self.get_cache_path()
+            records = None
+
+            if os.path.exists(cache_path):
+                try:
+                    records = self.read_cache(cache_path)
+                    logger.info(f"Loaded cached data from {cache_path}")
+                except Exception as e:
+                    # Drop the unreadable cache and rebuild it from the Excel file
+                    logger.warning(f"Could not read data cache {cache_path}: {e}")
+                    try:
+                        os.remove(cache_path)
+                    except OSError as e:
+                        logger.warning(f"Could not remove data cache {cache_path}: {e}")
+
+            if records is None:
+                records = self.read_excel()
+                if records is None:
+                    self.reset_data()
+                    return
+
+                # Save processed data so the next start can skip Excel parsing
+                if records['cipher_code']:
+                    self.write_cache(records, cache_path)
+
+            self.build_indexes(records)
+            self.record_count = len(records['cipher_code'])
 
-            # Check if we have at least 3 columns
-            if len(self.data.columns) < 3:
-                logger.error(f"Excel file has only {len(self.data.columns)} columns, expected at least 3")
-                self.data = pd.DataFrame()
-                return
+            # Show some sample cipher codes
+            if self.record_count > 0:
+                sample_ciphers = records['cipher_code'][:10]
+                logger.info(f"Sample cipher codes: {sample_ciphers}")
 
-            # Rename columns for easier access (adjust based on actual structure)
-            column_names = ['ep_code', 'ep_name', 'cipher_code']
-            if len(self.data.columns) >= 4:
-                column_names.append('cipher_name')
+            logger.info(f"Successfully loaded {self.record_count} records from Excel file")
 
-            # Only rename up to the number of columns we actually have
-            self.data.columns = column_names[:len(self.data.columns)]
+        except Exception as e:
+            logger.error(f"Error loading Excel file: {e}")
+            self.reset_data()
+
+    def reset_data(self):
+        """Clear loaded data and search indexes"""
+        self.record_count = 0
+        self.exact_index = {}
+        self.cipher_keys = []
+        self.ep_codes = []
+        self.ep_names = []
+        self.ngram_index = {}
+        self.cipher_choices = []
+        self.display_ciphers = {}
+        self.max_query_length = 0
+
+    def get_cache_path(self):
+        """Return Parquet cache path keyed on the cache version and the Excel file modification time and size"""
+        stat = os.stat(self.excel_file_path)
+        return f"{self.excel_file_path}.v{CACHE_VERSION}.{stat.st_mtime_ns}.{stat.st_size}.parquet"
+
+    def read_cache(self, cache_path):
+        """
+        Read processed records from the Parquet cache
 
-            # Process the data to handle the specific structure
-            processed_data = []
-            current_ep_code = None
-            current_ep_name = None
+        Returns:
+            dict: Processed records as ep_code, ep_name and cipher_code column lists
+        """
+        columns = ['ep_code', 'ep_name', 'cipher_code']
+        table = pq.read_table(cache_path, columns=columns, read_dictionary=columns)
+        return {column: dictionary_column_to_list(table.column(column)) for column in columns}
 
-            for index, row in self.data.iterrows():
-                # Check if this row has EP code and name (main educational program row)
-                if pd.notna(row['ep_code']) and pd.notna(row['ep_name']):
-                    current_ep_code = str(row['ep_code']).strip()
-                    current_ep_name = str(row['ep_name']).strip()
-
-                    # If this row also has a cipher code, add it
-                    if pd.notna(row['cipher_code']):
-                        cipher_code = str(row['cipher_code']).strip()
-                        if cipher_code not in ['nan', '']:
-                            processed_data.append({
-                                'ep_code': current_ep_code,
-                                'ep_name': current_ep_name,
-                                'cipher_code': cipher_code
-                            })
-
-                # If this row only has cipher code (continuation of previous EP)
-                elif pd.notna(row['cipher_code']) and current_ep_code and current_ep_name:
-                    cipher_code = str(row['cipher_code']).strip()
-                    if cipher_code not in ['nan', '']:
-                        processed_data.append({
-                            'ep_code': current_ep_code,
-                            'ep_name': current_ep_name,
-                            'cipher_code': cipher_code
-                        })
-
-            # Create new DataFrame from processed data
-            self.data = pd.DataFrame(processed_data)
+    def write_cache(self, records, cache_path):
+        """Save processed records to the Parquet cache without ever leaving a partial file at cache_path"""
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            pq.write_table(pa.table(records), temp_path)
+            os.replace(temp_path, cache_path)
+        except Exception as e:
+            logger.warning(f"Could not save data cache: {e}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+
+        logger.info(f"Saved data cache to {cache_path}")
+        self.remove_stale_caches(cache_path)
+
+    def remove_stale_caches(self, cache_path):
+        """Delete Parquet caches and unfinished cache writes left over from earlier versions of the Excel file or cache format"""
+        excel_path = glob.escape(self.excel_file_path)
+        stale_paths = glob.glob(f"{excel_path}.*.parquet") + glob.glob(f"{excel_path}.*.parquet.*.tmp")
+        for path in stale_paths:
+            if path == cache_path:
+                continue
+            try:
+                os.remove(path)
+                logger.info(f"Removed stale data cache {path}")
+            except OSError as e:
+                logger.warning(f"Could not remove stale data cache {path}: {e}")
+
+    def read_excel(self):
+        """
+        Read and process the Excel file
 
-            # Show some sample cipher codes
-            if len(self.data) > 0:
-                sample_ciphers = self.data['cipher_code'].head(10).tolist()
-                logger.info(f"Sample cipher codes: {sample_ciphers}")
+        Rows with both EP code and name start a new educational program,
+        following rows with only a cipher code belong to that program.
 
-            logger.info(f"Successfully loaded {len(self.data)} records from Excel file")
+        Returns:
+            dict: Processed records as ep_code, ep_name and cipher_code column lists,
+            or None if the file has an unexpected structure
+        """
+        records = {'ep_code': [], 'ep_name': [], 'cipher_code': []}
+        has_cipher_column = False
+        current_ep_code = None
+        current_ep_name = None
 
-        except Exception as e:
-            logger.error(f"Error loading Excel file: {e}")
-            self.data = pd.DataFrame()
+        # Stream cell values in read-only mode straight into the record columns
+        workbook = openpyxl.load_workbook(self.excel_file_path, read_only=True, data_only=True)
+        try:
+            for ep_code, ep_name, cipher_code in workbook.active.iter_rows(max_col=3, values_only=True):
+                # Check if this row has EP code and name (main educational program row)
+                if ep_code is not None and ep_name is not None:
+                    current_ep_code = cell_to_str(ep_code)
+                    current_ep_name = cell_to_str(ep_name)
+
+                if cipher_code is None:
+                    continue
+                has_cipher_column = True
+
+                cipher_code = cell_to_str(cipher_code)
+                if current_ep_code is not None and cipher_code not in ['nan', '']:
+                    records['ep_code'].append(current_ep_code)
+                    records['ep_name'].append(current_ep_name)
+                    records['cipher_code'].append(cipher_code)
+        finally:
+            workbook.close()
+
+        # Check if we have at least 3 columns
+        if not has_cipher_column:
+            logger.error("Excel file has no cipher codes in column C, expected at least 3 columns")
+            return None
+
+        return records
+
+    def build_indexes(self, records):
+        """
+        Build search indexes from processed records
+
+        Unique records are stored column-wise in cipher_keys, ep_codes and
+        ep_names, and the indexes refer to them by row id. All keys are
+        normalized with normalize_cipher:
+        exact_index: cipher code -> row ids of its unique programs
+        ngram_index: substring of 1 to 3 characters -> roaring bitmap of row ids
+        cipher_choices: unique cipher codes for fuzzy matching
+        display_ciphers: cipher code -> cipher code as written in the Excel file
+        max_query_length: longest query that can still match any cipher code
+
+        Args:
+            records (dict): ep_code, ep_name and cipher_code column lists
+        """
+        self.reset_data()
+
+        for cipher_code in records['cipher_code']:
+            self.display_ciphers.setdefault(normalize_cipher(cipher_code), cipher_code)
+
+        cipher_keys = map(normalize_cipher, records['cipher_code'])
+        unique_records = dict.fromkeys(zip(cipher_keys, records['ep_code'], records['ep_name']))
+        for row_id, (cipher_key, ep_code, ep_name) in enumerate(unique_records):
+            self.cipher_keys.append(cipher_key)
+            # Programs repeat across many ciphers, share a single string object for each
+            self.ep_codes.append(sys.intern(ep_code))
+            self.ep_names.append(sys.intern(ep_name))
+
+            self.exact_index.setdefault(cipher_key, []).append(row_id)
+            grams = {cipher_key[i:i + n] for n in (1, 2, 3) for i in range(len(cipher_key) - n + 1)}
+            for gram in grams:
+                self.ngram_index.setdefault(gram, []).append(row_id)
+
+        # Row ids were appended in ascending order, compress each posting list into a bitmap
+        self.ngram_index = {gram: BitMap(row_ids) for gram, row_ids in self.ngram_index.items()}
+        self.cipher_choices = list(self.exact_index)
+
+        # Longer queries are neither a substring of any cipher code nor within
+        # the fuzzy score cutoff: fuzz.ratio is at most 200 * len(cipher) / (len(query) + len(cipher))
+        if self.cipher_choices:
+            longest = max(map(len, self.cipher_choices))
+            self.max_query_length = int(longest * (200 / FUZZY_SCORE_CUTOFF - 1))
 
     def search_programs(self, cipher_query):
         """
@@ -103,45 +312,115 @@ class EducationalProgramBot:
             cipher_query (str): The cipher code to search for (e.g., "070107 3")
 
         Returns:
-            list: List of unique matching programs with format "EP_Code - EP_Name"
+            tuple: (programs, suggestion) where programs are the unique matching programs
+            with format "EP_Code - EP_Name" and suggestion is the closest cipher code
+            when nothing matched, otherwise None
         """
-        if self.data is None or self.data.empty:
-            return []
+        if not self.record_count:
+            return (), None
 
         # Clean the query
-        cipher_query = cipher_query.strip()
+        cipher_query = normalize_cipher(cipher_query)
 
-        # Search for exact matches first
-        exact_matches = self.data[self.data['cipher_code'] == cipher_query]
+        # Reject queries too long to match anything before touching the indexes
+        if len(cipher_query) > self.max_query_length:
+            return (), None
+
+        programs = self.search_cache(cipher_query)
+        if programs:
+            return programs, None
 
-        if not exact_matches.empty:
-            results = []
-            seen = set()  # To track duplicates
+        # If nothing contains the query, suggest the closest cipher code to tolerate typos
+        return (), self.find_closest_cipher(cipher_query)
 
-            for _, row in exact_matches.iterrows():
-                result = f"{row['ep_code']} - {row['ep_name']}"
-                # Only add if we haven't seen this exact combination before
-                if result not in seen:
-                    results.append(result)
-                    seen.add(result)
-            return results
+    def find_programs(self, cipher_query):
+        """
+        Look up programs for a cleaned cipher query in the search indexes
+
+        Args:
+            cipher_query (str): The cipher code normalized with normalize_cipher
+
+        Returns:
+            tuple: Unique matching programs with format "EP_Code - EP_Name"
+        """
+        # Search for exact matches first
+        exact_matches = self.exact_index.get(cipher_query)
+
+        if exact_matches:
+            return self.format_programs(exact_matches)
 
         # If no exact match, try partial matching
-        partial_matches = self.data[self.data['cipher_code'].str.contains(cipher_query, case=False, na=False)]
+        partial_matches = self.find_partial_matches(cipher_query)
 
-        if not partial_matches.empty:
-            results = []
-            seen = set()  # To track duplicates
+        if partial_matches:
+            return self.format_programs(partial_matches)
 
-            for _, row in partial_matches.iterrows():
-                result = f"{row['ep_code']} - {row['ep_name']}"
-                # Only add if we haven't seen this exact combination before
-                if result not in seen:
-                    results.append(result)
-                    seen.add(result)
-            return results
+        return ()
 
-        return []
+    def find_closest_cipher(self, cipher_query):
+        """
+        Find the known cipher code the query most likely misspells
+
+        Codes of the same length that differ only in digits are distinct
+        specialties, so they are never suggested.
+
+        Args:
+            cipher_query (str): The cipher code normalized with normalize_cipher
+
+        Returns:
+            str: The closest cipher code as written in the Excel file, or None
+        """
+        candidates = process.extract(
+            cipher_query, self.cipher_choices, scorer=fuzz.ratio, score_cutoff=FUZZY_SCORE_CUTOFF, limit=None
+        )
+        for cipher_key, _, _ in candidates:
+            if not is_digit_substitution(cipher_query, cipher_key):
+                return self.display_ciphers[cipher_key]
+        return None
+
+    def find_partial_matches(self, cipher_query):
+        """
+        Find rows whose cipher code contains the query
+
+        Args:
+            cipher_query (str): The cipher code normalized with normalize_cipher
+
+        Returns:
+            list: Matching row ids in the order they appear in the data
+        """
+        if len(cipher_query) > 3:
+            grams = {cipher_query[i:i + 3] for i in range(len(cipher_query) - 2)}
+            postings = []
+            for gram in grams:
+                posting = self.ngram_index.get(gram)
+                if not posting:
+                    return []
+                postings.append(posting)
+            # Intersect posting lists starting from the smallest one,
+            # bitmaps iterate in ascending row id order
+            postings.sort(key=len)
+            candidates = BitMap.intersection(*postings)
+            # Trigrams may match at different positions, check for the whole query
+            return [row_id for row_id in candidates if cipher_query in self.cipher_keys[row_id]]
+
+        # Queries of up to 3 characters are indexed as a whole, so every
+        # posting already contains the query
+        if cipher_query:
+            return list(self.ngram_index.get(cipher_query, ()))
+        return list(range(len(self.cipher_keys)))
+
+    def format_programs(self, row_ids):
+        """
+        Format programs for the given rows as "EP_Code - EP_Name"
+
+        Args:
+            row_ids (list): Row ids into the record columns
+
+        Returns:
+            tuple: Unique formatted programs in first-seen order
+        """
+        programs = dict.fromkeys((self.ep_codes[row_id], self.ep_names[row_id]) for row_id in row_ids)
+        return tuple(f"{ep_code} - {ep_name}" for ep_code, ep_name in programs)
 
 # Initialize bot instance (will be set when Excel file is provided)
 bot_instance = None
@@ -184,11 +463,10 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Check bot status and data availability."""
     global bot_instance
 
-    if bot_instance is None or bot_instance.data is None or bot_instance.data.empty:
+    if bot_instance is None or not bot_instance.record_count:
         status_text = "❌ Данные не загружены. Обратитесь к администратору."
     else:
-        record_count = len(bot_instance.data)
-        status_text = f"✅ Бот работает нормально\n📊 Загружено записей: {record_count}"
+        status_text = f"✅ Бот работает нормально\n📊 Загружено записей: {bot_instance.record_count}"
 
     await update.message.reply_text(status_text)
 
@@ -202,25 +480,58 @@ async def search_cipher(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
     cipher_query = update.message.text.strip()
 
-    # Search for matching programs
-    results = bot_instance.search_programs(cipher_query)
-
-    if results:
-        # Format header normally
-        response = f"Найденные программы для шифра '{cipher_query}':\n\n"
-
-        # Format results in monospace for easy copying
-        monospace_results = "\n".join(results)
-        response += f"```\nВы можете поступить в наш университет по данным ГОП:\n{monospace_results}\n\nСписок необходимых документов:\n1. Диплом с приложением (оригинал + копия)\n2. Сертификат ЕНТ при сдаче.\n3. Копия удостоверения личности.\n4. Медицинская справка формы 075-у со снимком флюрографии.\n5. Медицинская справка формы 063 (паспорт здоровья).\n6. Фотография 3х4 в электронном формате.\n\nДля дополнительной информации: https://www.ektu.kz/admissiondetails.aspx?ttab=1```"
-
-        # Add count information normally
-        response += f"\n\nВсего найдено: {len(results)} программ(ы)"
-
+    # Reuse the formatted reply if this query was answered recently
+    response = bot_instance.response_cache.get(cipher_query)
+    if response is not None:
+        bot_instance.response_cache.move_to_end(cipher_query)
     else:
-        response = f"❌ Не найдено программ для шифра '{cipher_query}'\n\n"
-        response += "Проверьте правильность написания шифра.\n\n Если данная ошибка повторяется, то у нас нет ГОП по данному шифру"
+        # Search for matching programs off the event loop, sharing the search
+        # with concurrent requests for the same query
+        search = bot_instance.inflight.get(cipher_query)
+        if search is None:
+            search = asyncio.get_running_loop().run_in_executor(
+                bot_instance.executor, bot_instance.search_programs, cipher_query
+            )
+            bot_instance.inflight[cipher_query] = search
+            search.add_done_callback(lambda _: bot_instance.inflight.pop(cipher_query, None))
+        results, suggestion = await search
+
+        if results:
+            # Format results in monospace for easy copying
+            response = (
+                RESPONSE_PREFIX_FMT.format(q=cipher_query)
+                + "\n".join(results)
+                + RESPONSE_DOCS_BLOCK
+                + RESPONSE_COUNT_FMT.format(count=len(results))
+            )
+        elif suggestion:
+            response = DID_YOU_MEAN_FMT.format(q=cipher_query, cipher=suggestion)
+        else:
+            response = NOT_FOUND_FMT.format(q=cipher_query)
+
+        bot_instance.response_cache[cipher_query] = response
+        if len(bot_instance.response_cache) > bot_instance.response_cache_size:
+            bot_instance.response_cache.popitem(last=False)
+
+    # If this chat just got the same reply, point back to it instead of sending it again
+    chat_id = update.effective_chat.id
+    response_hash = hashlib.blake2b(response.encode(), digest_size=8).hexdigest()
+    last_response = bot_instance.last_responses.get(chat_id)
+    if (
+        last_response is not None
+        and last_response[1] == response_hash
+        and time.monotonic() - last_response[2] < bot_instance.same_response_window
+    ):
+        await update.message.reply_text(
+            SAME_RESPONSE_TEXT, reply_to_message_id=last_response[0], allow_sending_without_reply=True
+        )
+        return
 
-    await update.message.reply_text(response, parse_mode='Markdown')
+    message = await update.message.reply_text(response, parse_mode='Markdown')
+    bot_instance.last_responses[chat_id] = (message.message_id, response_hash, time.monotonic())
+    bot_instance.last_responses.move_to_end(chat_id)
+    if len(bot_instance.last_responses) > bot_instance.last_responses_size:
+        bot_instance.last_responses.popitem(last=False)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message to notify the developer."""
@@ -266,5 +577,7 @@ def main():
     logger.info("Starting bot...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+    bot_instance.executor.shutdown()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file